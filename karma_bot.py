@@ -1,30 +1,56 @@
 #!/usr/bin/env python
 import argparse
-import asyncio
 import re
 import sys
 import time
 import sqlite3
 import json
-import aiohttp
-from functools import partial
-from curio import run, socket, sleep, run_in_thread
-from curio.bridge import AsyncioLoop, asyncio_coroutine
-from curio.errors import TaskCancelled
-from curio.socket import AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from curio import run, socket, sleep, spawn, run_in_executor, Event, open_connection, timeout_after
+from curio.errors import TaskCancelled, TaskTimeout
+from curio.socket import AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, IPPROTO_TCP, TCP_NODELAY
 
 parser = argparse.ArgumentParser()
 parser.add_argument("server", help="the IRC server address")
 parser.add_argument("--port", help="the IRC server's port (defaults to 6667)", type=int, default=6667)
-parser.add_argument("--proxy", help="proxy URL to tunnel requests through (WIP)")
 parser.add_argument("--initdb", help="initialize the database")
+parser.add_argument("--verbose", help="print every line received from the server", action="store_true")
 arguments = parser.parse_args()
 
 encoding = 'UTF-8'
 
-karma_pattern = r'(?:((@?[aA-zZ\w]+)|[\'"].+?[\'"]))(?:(\+{2,}|\-{2,}))'
+strawpoll_url = 'http://www.strawpoll.me/api/v2/polls'
+strawpoll_timeout = 10
+
+# ---- exactly '++' or '--', longer runs like 'bob+++' are not karma
+karma_pattern = r'(@?\w+|"[^"]+"|\'[^\']+\')(\+\+|--)(?![+-])'
 karma_reg = re.compile(karma_pattern)
 
+db_pragmas = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-64000',
+)
+users_name_index = 'CREATE UNIQUE INDEX IF NOT EXISTS idx_users_name ON users(name)'
+# ---- older databases may hold several rows per name, fold them into the oldest one
+merge_duplicate_users = (
+    'UPDATE users SET karma = (SELECT SUM(dup.karma) FROM users dup WHERE dup.name = users.name) '
+    'WHERE id IN (SELECT MIN(id) FROM users GROUP BY name HAVING COUNT(*) > 1)',
+    'DELETE FROM users WHERE id NOT IN (SELECT MIN(id) FROM users GROUP BY name)',
+)
+
+# ---- kept as module constants so sqlite's statement cache sees the same strings
+sql_select_karma = 'SELECT name, karma FROM users WHERE name IN ({0})'
+sql_insert_users = 'INSERT OR IGNORE INTO users (name, karma) VALUES (?, 0)'
+sql_add_karma = 'UPDATE users SET karma = karma + ? WHERE name = ?'
+
+# ---- seconds to gather writes before a group commit
+commit_window = 0.025
+polls_size = 256
+
 strawpoll_pattern = r'[\'"]([^\'"]*)[\'"]'
 strawpoll_reg = re.compile(strawpoll_pattern)
 
@@ -34,27 +60,87 @@ class ConnectionError(Exception):
 
 class KarmaBot(object):
 
-    def __init__(self, server, port, user='kbot', nick=None, db=None, proxy=None):
+    _PONG = b'PONG '
+    _QUIT = b'QUIT \n'
+    _CAPS = b'CAPS LS\n'
+    _NICK = b'NICK '
+    _USER = b'USER '
+    _JOIN = b'JOIN '
+    _PART = b'PART '
+    _PRIVMSG_PREFIX = b'PRIVMSG '
+    _COLON = b' :'
+    _NL = b'\n'
+
+    def __init__(self, server, port, user='kbot', nick=None, db=None, verbose=False):
         self.server = server
         self.port = port
         self.user = user
         self.nick = nick if nick else 'KarmaBot'
         self.command_nick = self.nick.lower()
         self._socket = None
-        self.polls = {}
+        # ---- encoded names of the channels we're in, filled on join, drained on part
+        self._channel_bytes = {}
+        # ---- (token, frame) for the last PING, servers usually repeat the token
+        self._pong = (None, None)
+        # ---- one receive buffer for the life of the bot, see _readline
+        self._rxbuf = bytearray(8192)
+        self._rxlen = 0
+        # ---- poll id -> title, oldest first, see _remember_poll
+        self.polls = OrderedDict()
         self._connected = False
         self.exit_code = '.{0} quit'.format(self.nick.lower())
-        self.proxy = proxy
+        self._command_nick_dot = '.{0}'.format(self.command_nick).encode(encoding)
+        self._usage_joinleave = 'Uses: .{0} [join|leave] [#channel1, #channel2, ...]'.format(
+            self.command_nick).encode(encoding)
+        self._usage_listkarma = 'Uses: .{0} list-karma [top|bottom|name]'.format(
+            self.command_nick).encode(encoding)
+        self._help_lines = tuple(line.encode(encoding) for line in (
+            'Commands available:',
+            '.{0} [join|leave] [#server1, #server2, ...]'.format(self.command_nick),
+            '.{0} list-karma [top|bottom|name]'.format(self.command_nick),
+            '.{0} quit'.format(self.command_nick)))
+        self._commands = {
+            'join': self._handle_join,
+            'leave': self._handle_leave,
+            'list-karma': self._handle_list_karma,
+            'strawpoll': self._handle_strawpoll,
+            'help': self._handle_help,
+            'quit': self._handle_quit,
+        }
+        # ---- one compiled alternation recognizes every command in a single match
+        self._command_reg = re.compile(r'\.{0} ({1})\b'.format(
+            re.escape(self.command_nick), '|'.join(map(re.escape, self._commands))))
+        self.verbose = verbose
         if not db:
             db = sqlite3.connect('karma.db', check_same_thread=False)
         self.db = db
         self.cursor = db.cursor()
+        # ---- every sqlite call goes through this one warm thread
+        self._sql_exec = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+        self._committer = None
+        self._commit_pending = Event()
+        self._prepare_db()
+
+    def _prepare_db(self):
+        '''raises sqlite3.Error if users.name can't be made unique, karma updates rely on it'''
+        for pragma in db_pragmas:
+            self.cursor.execute(pragma)
+        try:
+            for statement in merge_duplicate_users:
+                self.cursor.execute(statement)
+            self.cursor.execute(users_name_index)
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            raise
 
     def _create_socket(self):
         # ---- socket is called synchronously but uses async methods
         if not self._socket:
             sock = socket.socket(AF_INET, SOCK_STREAM)
             sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            # ---- IRC frames are tiny, send each one now instead of waiting on Nagle
+            sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
             self._socket = sock
         return self._socket
 
@@ -91,40 +177,52 @@ class KarmaBot(object):
 
     async def leave_server(self):
         if self._connected:
-            await self.conn.send(bytes('QUIT \n', encoding))
+            await self.conn.send(self._QUIT)
 
     async def close_connection(self):
         if self._socket:
             await self._socket.close()
         self._socket = None
+        self._rxlen = 0
 
     async def login(self):
-        await self.conn.send(bytes('CAPS LS\n', encoding))
-        await self.conn.send(bytes('NICK {0}\n'.format(self.nick), encoding))
-        await self.conn.send(bytes('USER {nickname} 8 * {nickname}\n'.format(nickname=self.nick), encoding))
+        nick = self.nick.encode(encoding)
+        await self.conn.send(self._CAPS)
+        await self.conn.send(b''.join((self._NICK, nick, self._NL)))
+        await self.conn.send(b''.join((self._USER, nick, b' 8 * ', nick, self._NL)))
 
     async def send_msg(self, message, target=None):
+        '''message may be str or already-encoded bytes'''
         if target is None:
             print('Received message but no target channel:', message)
-        await self.conn.send(bytes('PRIVMSG {target} :{message}\n'.format(
-            target=target,
-            message=message), encoding))
-
-    async def respond_to_ping(self):
-        await self.conn.send(bytes('PONG :pingis\n', encoding))
+        if isinstance(message, str):
+            message = message.encode(encoding)
+        target_b = self._channel_bytes.get(target) or str(target).encode(encoding)
+        await self.conn.send(b''.join((
+            self._PRIVMSG_PREFIX, target_b, self._COLON, message, self._NL)))
+
+    async def respond_to_ping(self, token=b':pingis'):
+        last_token, pong = self._pong
+        if token != last_token:
+            pong = b''.join((self._PONG, token, self._NL))
+            self._pong = (token, pong)
+        await self.conn.send(pong)
 
     async def join_rooms(self, channels=None, summoner=None):
         if not channels:
             return
         if not summoner:
             summoner = 'A mysterious force'
-        channels_string = ','.join(channels)
-        await self.conn.send(bytes('JOIN {0}\n'.format(channels_string), encoding))
-        recv_msg = ''
-        while recv_msg.find('End of /NAMES list.') == -1:
-            recv_msg = await self.conn.recv(2048)
-            recv_msg = recv_msg.decode(encoding).strip('\n\r')
-            print(recv_msg)
+        for channel in channels:
+            self._channel_bytes[channel] = channel.encode(encoding)
+        await self.conn.send(b''.join((
+            self._JOIN, b','.join(self._channel_bytes[channel] for channel in channels), self._NL)))
+        while True:
+            line = await self._readline()
+            if self.verbose:
+                print(line.decode(encoding, 'replace'))
+            if b'End of /NAMES list.' in line:
+                break
         for channel in channels:
             await self.send_msg('{0} has summoned me. '
                           'Type \'.{1} help\' for commands'.format(summoner, self.command_nick), target=channel)
@@ -134,18 +232,19 @@ class KarmaBot(object):
             return
         if not summoner:
             summoner = 'A mysterious force'
-        channels_string = ','.join(channels)
         for channel in channels:
             await self.send_msg('Disconnecting... (requested by: {0})'.format(summoner), target=channel)
-        await self.conn.send(bytes('PART {0}\n'.format(channels_string), encoding))
+        await self.conn.send(b''.join((
+            self._PART, b','.join(self._channel_bytes.pop(channel, None) or channel.encode(encoding)
+                                  for channel in channels), self._NL)))
 
     async def list_karma(self, modifier='top'):
         statement = 'SELECT * FROM users '
         if modifier == 'top':
-            heading = 'Top karma:\n'
+            heading = 'Top karma: '
             statement = statement + 'ORDER BY KARMA desc LIMIT 3'
         elif modifier == 'bottom':
-            heading = 'Bottom karma:\n'
+            heading = 'Bottom karma: '
             statement = statement + 'ORDER BY KARMA asc LIMIT 3'
         else:
             heading = ''
@@ -157,67 +256,204 @@ class KarmaBot(object):
             res = [(0, modifier, 0)]
         return heading, res
 
-    async def _process_karma(self, target, change, room):
-        token = 'increased'
-        sign = 1
-        if change[:1] == '-':
-            token = 'decreased'
-            sign = -1
-        user = await self.query_user(target)
-        if not user:
-            user = await self.create_user(target)
-        amount = len(change) - 1
-        current_amount = user[2]
-        new_amount = current_amount + sign * amount
-        await self.update_user_karma(user[0], new_amount)
-        await self.send_msg('{target}\'s karma has been {token} to {new_amount}.'.format(
-            target=target,
-            token=token,
-            new_amount=new_amount), target=room)
-
-    async def query_user(self, username):
-        res = await self.execute('SELECT * from users where name = :name', {'name': username})
-        user = res.fetchone()
-        return user
-
-    async def create_user(self, username):
+    async def _process_karma_batch(self, pairs, room):
+        '''pairs is a sequence of (target, change) tuples, e.g. ('bob', '++')'''
+        deltas = {}
+        for target, change in pairs:
+            deltas[target] = deltas.get(target, 0) + (1 if change[0] == '+' else -1)
         try:
-            await self.execute('INSERT INTO users (name, karma) VALUES (:name, 0)', {
-            'name': username})
-            await self.commit()
-        except Exception as error:
-            await self.rollback()
-            print('Error creating user:', error)
-        else:
-            return await self.query_user(username)
+            karma = await self._run(self._apply_karma, deltas)
+        except sqlite3.Error as error:
+            print('Error updating karma:', error)
+            return
+        await self.commit()
+        for target, delta in deltas.items():
+            if not delta:
+                continue
+            token = 'increased' if delta > 0 else 'decreased'
+            await self.send_msg('{target}\'s karma has been {token} to {new_amount}.'.format(
+                target=target,
+                token=token,
+                new_amount=karma[target]), target=room)
+
+    def _apply_karma(self, deltas):
+        '''runs on the sqlite thread, returns {name: karma} after applying deltas
+
+        The writes sit in a savepoint so a failure only undoes this message,
+        not earlier ones still waiting for the group commit.
+        '''
+        if not self.db.in_transaction:
+            self.cursor.execute('BEGIN')
+        self.cursor.execute('SAVEPOINT karma_batch')
+        try:
+            self.cursor.executemany(sql_insert_users, [(name,) for name in deltas])
+            self.cursor.executemany(sql_add_karma, [(delta, name) for name, delta in deltas.items()])
+        except sqlite3.Error:
+            self.cursor.execute('ROLLBACK TO karma_batch')
+            raise
+        finally:
+            self.cursor.execute('RELEASE karma_batch')
+        res = self.cursor.execute(sql_select_karma.format(', '.join('?' * len(deltas))), tuple(deltas))
+        return dict(res.fetchall())
+
+    async def _run(self, fn, *args):
+        return await run_in_executor(self._sql_exec, fn, *args)
+
+    def _commit(self):
+        # ---- back-to-back commits collapse into one, the rest are no-ops
+        if self.db.in_transaction:
+            self.db.commit()
+
+    async def start_group_commit(self):
+        if not self._committer:
+            self._committer = await spawn(self._group_committer(), daemon=True)
+
+    async def _group_committer(self):
+        while True:
+            await self._commit_pending.wait()
+            self._commit_pending.clear()
+            await sleep(commit_window)
+            try:
+                await self._run(self._commit)
+            except Exception as error:
+                print('Error committing karma:', error)
+                try:
+                    await self.rollback()
+                except Exception as error:
+                    print('Error rolling back:', error)
 
     async def commit(self):
-        return await run_in_thread(self.db.commit)
+        '''with the group committer running this only schedules the commit,
+        it lands within commit_window and close_db flushes whatever is left'''
+        if not self._committer:
+            return await self._run(self._commit)
+        await self._commit_pending.set()
 
     async def rollback(self):
-        return await run_in_thread(self.db.rollback)
+        return await self._run(self.db.rollback)
 
-    async def execute(self, *args, **kwargs):
-        return await run_in_thread(self.cursor.execute, *args, **kwargs)
+    async def execute(self, *args):
+        return await self._run(self.cursor.execute, *args)
 
-    async def update_user_karma(self, userid, new_karma):
-        '''user is a tuple of (id, name, karma)'''
+    def close_db(self):
+        self._sql_exec.shutdown()
+        # ---- writes the group committer hasn't flushed yet
         try:
-            await self.execute('UPDATE users SET karma = :karma where id = :id', {
-                'karma': new_karma,
-                'id': userid})
-            await self.commit()
-        except Exception as error:
-            await self.rollback()
-            print('Error updating user karma:', error)
+            self._commit()
+        except sqlite3.Error as error:
+            print('Error committing karma:', error)
+        self.db.close()
+
+    async def _handle_join(self, message, channel, name):
+        target = message.split(' ', 2)
+        if len(target) != 3:
+            await self.send_msg(self._usage_joinleave, target=channel)
+        else:
+            rooms = target[2].split()
+            await self.join_rooms(channels=rooms, summoner=name)
+
+    async def _handle_leave(self, message, channel, name):
+        target = message.split(' ', 2)
+        if len(target) != 3:
+            await self.send_msg(self._usage_joinleave, target=channel)
+        else:
+            rooms = target[2].split()
+            await self.leave_rooms(channels=rooms, summoner=name)
+
+    async def _handle_list_karma(self, message, channel, name):
+        args = message.split(' ', 2)
+        if len(args) != 3:
+            await self.send_msg(self._usage_listkarma, target=channel)
+        else:
+            modifier = args[2]
+            header, results = await self.list_karma(modifier)
+            # ---- one PRIVMSG for the whole listing, IRC lines can't carry newlines
+            await self.send_msg(header + ', '.join(
+                '{0}: {1}'.format(result[1], result[2]) for result in results), target=channel)
+
+    async def _handle_strawpoll(self, message, channel, name):
+        error = ("Not enough arguments supplied for strawpoll command. "
+                 "<PollTitle> <quoted options separated by spaces>"
+                 "Ex: .strawpollbot strawpoll 'Where shall we eat "
+                 "today?' 'Ramensan' 'Ajida' 'Slurping Turtle'")
+        args = message.split(' ', 2)
+        if len(args) != 3:
+            await self.send_msg(error, target=channel)
+        else:
+            try:
+                pollID, options = self.parseStrawPollArgs(args[2])
+            except ValueError as error:
+                await self.send_msg(
+                    'Not enough arguments to create a '
+                    'Strawpoll. Please provide a poll title, '
+                    'and at least 2 poll options',
+                    target=channel)
+            else:
+                data = {}
+                data['title'] = pollID
+                data['options'] = options
+                data['multi'] = False
+                payload = json.dumps(data)
+                try:
+                    status, resp_data = await timeout_after(
+                        strawpoll_timeout, post_json(strawpoll_url, payload))
+                    if status != 200:
+                        raise ValueError('strawpoll answered {0}: {1}'.format(status, resp_data))
+                    poll_id, poll_title = resp_data['id'], resp_data['title']
+                except (OSError, ValueError, IndexError, KeyError, TypeError, TaskTimeout) as err:
+                    print(err)
+                    await self.send_msg('I wasn\'t able to contact the '
+                                  'strawpoll server... ;(', target=channel)
+                else:
+                    self._remember_poll(poll_id, poll_title)
+                    await self.send_msg('Poll \'{0}\': {1}'.format(
+                        poll_title,
+                        'http://www.strawpoll.me/' + str(poll_id)),
+                        target=channel)
+
+    async def _handle_help(self, message, channel, name):
+        for line in self._help_lines:
+            await self.send_msg(line, target=channel)
+
+    async def _handle_quit(self, message, channel, name):
+        '''returns True when the bot should stop listening'''
+        if message.rstrip() == self.exit_code:
+            await self.conn.send(self._QUIT)
+            return True
+
+    async def _readline(self):
+        '''returns the next IRC line from the server as bytes, minus the line ending'''
+        while True:
+            end = self._rxbuf.find(b'\n', 0, self._rxlen)
+            if end != -1:
+                line = bytes(self._rxbuf[:end]).rstrip(b'\r')
+                rest = self._rxlen - end - 1
+                self._rxbuf[:rest] = self._rxbuf[end + 1:self._rxlen]
+                self._rxlen = rest
+                return line
+            if self._rxlen == len(self._rxbuf):
+                # ---- no line ending in a full buffer, drop the runaway line
+                self._rxlen = 0
+            nbytes = await self.conn.recv_into(memoryview(self._rxbuf)[self._rxlen:])
+            if not nbytes:
+                raise ConnectionError('Connection closed by the server')
+            self._rxlen += nbytes
 
     async def listen(self):
         while True:
             # ---- karma can only be granted in channels, not DM's with karmabot
             karma_eligible = False
-            recv_msg = await self.conn.recv(2048)
-            recv_msg = recv_msg.decode(encoding).strip('\n\r')
-            print(recv_msg)
+            line = await self._readline()
+            if self.verbose:
+                print(line.decode(encoding, 'replace'))
+            if line.startswith(b'PING '):
+                await self.respond_to_ping(line[5:])
+                continue
+            # ---- skip parsing lines that can't hold a command or a karma change
+            if (self._command_nick_dot not in line
+                    and b'++' not in line and b'--' not in line):
+                continue
+            recv_msg = line.decode(encoding, 'replace')
             if recv_msg.find('PRIVMSG') != -1:
                 name = recv_msg.split('!', 1)[0][1:]
                 source, message = recv_msg.split('PRIVMSG', 1)[1].split(':', 1)
@@ -227,96 +463,19 @@ class KarmaBot(object):
                     # ---- we came from a channel
                     channel = source
                     karma_eligible = True
-                if message[:14] == '.{0} join'.format(self.command_nick):
-                    target = message.split(' ', 2)
-                    if len(target) != 3:
-                        await self.send_msg(
-                            'Uses: .{0} [join|leave] [#channel1, #channel2, ...]'.format(self.command_nick),
-                            target=channel)
-                    else:
-                        target = target[2]
-                        rooms = list(target.split(' '))
-                        await self.join_rooms(channels=rooms, summoner=name)
-                if message[:15] == '.{0} leave'.format(self.command_nick):
-                    target = message.split(' ', 2)
-                    if len(target) != 3:
-                        await self.send_msg('Uses: .{0} [join|leave] [#channel1, #channel2, ...]'.format(self.command_nick), target=channel)
-                    else:
-                        target = target[2]
-                        rooms = list(target.split(' '))
-                        await self.leave_rooms(channels=rooms, summoner=name)
-                if karma_eligible:
+                # ---- cheap substring test first, most lines carry no karma at all
+                if karma_eligible and ('++' in message or '--' in message):
                     karma_changed = karma_reg.findall(message)
                     if karma_changed:
-                        for group in karma_changed:
-                            await self._process_karma(group[0], group[2], channel)
-                if message[:20] == '.{0} list-karma'.format(self.command_nick):
-                    args = message.split(' ', 2)
-                    if len(args) != 3:
-                        await self.send_msg('Uses: .{0} list-karma [top|bottom|name]'.format(self.command_nick), target=channel)
-                    else:
-                        modifier = args[2]
-                        header, results = await self.list_karma(modifier)
-                        await self.send_msg(header, target=channel)
-                        for result in results:
-                            await self.send_msg('{0}: {1}'.format(result[1], result[2]), target=channel)
-                if message[:19] == '.karmabot strawpoll':
-                    error = ("Not enough arguments supplied for strawpoll command. "
-                             "<PollTitle> <quoted options separated by spaces>"
-                             "Ex: .strawpollbot strawpoll 'Where shall we eat "
-                             "today?' 'Ramensan' 'Ajida' 'Slurping Turtle'")
-                    args = message.split(' ', 2)
-                    if len(args) != 3:
-                        await self.send_msg(error, target=channel)
-                    else:
-                        try:
-                            pollID, options = self.parseStrawPollArgs(args[2])
-                        except ValueError as error:
-                            await self.send_msg(
-                                'Not enough arguments to create a '
-                                'Strawpoll. Please provide a poll title, '
-                                'and at least 2 poll options',
-                                target=channel)
-                        else:
-                            data = {}
-                            data['title'] = pollID
-                            data['options'] = options
-                            data['multi'] = False
-                            payload = json.dumps(data)
-                            loop = asyncio.get_event_loop()
-                            session = aiohttp.ClientSession(loop=loop)
-                            async with AsyncioLoop(event_loop=loop) as aioloop:
-                                try:
-                                    resp = await aioloop.run_asyncio(partial(
-                                        session.request,
-                                            'POST',
-                                            'http://www.strawpoll.me/api/v2/polls',
-                                            data=payload,
-                                            timeout=None,
-                                            proxy=self.proxy))
-                                except aiohttp.client_exceptions.ClientConnectionError as err:
-                                    print(err)
-                                    await self.send_msg('I wasn\'t able to contact the '
-                                                  'strawpoll server... ;(', target=channel)
-                                else:
-                                    resp_data = await resp.json()
-                                    self.polls[str(resp_data['id'])] = resp_data['title']
-                                    await self.send_msg('Poll \'{0}\': {1}'.format(
-                                        resp_data['title'],
-                                        'http://www.strawpoll.me/' + str(resp_data['id'])),
-                                        target=channel)
-                                    session.close()
-                if message[:14] == '.{0} help'.format(self.command_nick):
-                    await self.send_msg('Commands available:', target=channel)
-                    await self.send_msg('.{0} [join|leave] [#server1, #server2, ...]'.format(self.command_nick), target=channel)
-                    await self.send_msg('.{0} list-karma [top|bottom|name]'.format(self.command_nick), target=channel)
-                    await self.send_msg('.{0} quit'.format(self.command_nick), target=channel)
-                if message.rstrip() == self.exit_code:
-                    await self.conn.send(bytes('QUIT \n', encoding))
+                        await self._process_karma_batch(karma_changed, channel)
+                command = self._command_reg.match(message)
+                if command and await self._commands[command.group(1)](message, channel, name):
                     return
-            else:
-                if recv_msg.find('PING :') != -1:
-                    await self.respond_to_ping()
+
+    def _remember_poll(self, poll_id, title):
+        self.polls[str(poll_id)] = title
+        if len(self.polls) > polls_size:
+            self.polls.popitem(last=False)
 
     def parseStrawPollArgs(self, args):
         parsed = strawpoll_reg.findall(args)
@@ -327,26 +486,72 @@ class KarmaBot(object):
         options = parsed[1:]
         return (pollTitle, options)
 
-async def main(server, port, proxy):
-    bot = KarmaBot(server, port, proxy=proxy)
+def decode_chunked(body):
+    '''undoes Transfer-Encoding: chunked on a complete response body'''
+    decoded = []
+    while True:
+        size_line, _, body = body.partition(b'\r\n')
+        size = int(size_line.split(b';', 1)[0], 16)
+        if not size:
+            return b''.join(decoded)
+        decoded.append(body[:size])
+        body = body[size + 2:]
+
+async def post_json(url, payload):
+    '''minimal HTTP/1.1 POST for plain http:// APIs, returns (status, decoded JSON body)'''
+    parts = urlsplit(url)
+    body = payload.encode(encoding)
+    request = ('POST {path} HTTP/1.1\r\n'
+               'Host: {host}\r\n'
+               'Content-Type: application/json\r\n'
+               'Content-Length: {length}\r\n'
+               'Connection: close\r\n\r\n').format(
+        path=parts.path or '/', host=parts.netloc, length=len(body)).encode('ascii')
+    sock = await open_connection(parts.hostname, parts.port or 80)
+    async with sock:
+        await sock.sendall(request + body)
+        chunks = []
+        while True:
+            chunk = await sock.recv(4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    head, _, resp_body = b''.join(chunks).partition(b'\r\n\r\n')
+    lines = head.decode('iso-8859-1').split('\r\n')
+    status = int(lines[0].split(' ', 2)[1])
+    headers = {}
+    for line in lines[1:]:
+        key, _, value = line.partition(':')
+        headers[key.strip().lower()] = value.strip().lower()
+    if 'chunked' in headers.get('transfer-encoding', ''):
+        resp_body = decode_chunked(resp_body)
+    return status, json.loads(resp_body.decode(encoding))
+
+async def main(server, port, verbose):
+    try:
+        bot = KarmaBot(server, port, verbose=verbose)
+    except sqlite3.Error as error:
+        print('Error preparing the database:', error)
+        sys.exit(1)
     try:
         await bot._connect()
     except ConnectionError as error:
         print('Connection Error:', error)
-        bot.db.close()
+        bot.close_db()
         sys.exit(1)
     try:
+        await bot.start_group_commit()
         await bot.listen()
     except (TaskCancelled, KeyboardInterrupt) as signal:
         print('Shutting down... because:', signal)
-        bot.db.close()
+        bot.close_db()
         sys.exit(0)
     except Exception as error:
         print('Error:', error)
-        bot.db.close()
+        bot.close_db()
         sys.exit(1)
     else:
-        bot.db.close()
+        bot.close_db()
         sys.exit(0)
 
 def initdb():
@@ -356,6 +561,7 @@ def initdb():
     cursor.execute('CREATE TABLE users(id INTEGER PRIMARY KEY, '
                    'name TEXT, '
                    'karma INTEGER)')
+    cursor.execute(users_name_index)
     try:
         db.commit()
     except Exception as error:
@@ -371,5 +577,4 @@ if __name__ == '__main__':
         print('Database initialized')
     server = arguments.server
     port = arguments.port
-    proxy = arguments.proxy
-    run(main(server, port, proxy), with_monitor=True)
+    run(main(server, port, arguments.verbose), with_monitor=True)